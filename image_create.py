@@ -13,7 +13,12 @@ Usage:
                   [--color-temp {1000,1500,2000,2500,3000,3500,4000,4500,5000,5500,6000,6500,7000,7500,8000,8500,9000,9500,10000}]
                   [-f OUTPUT_FMT] [--inset-bottom INSET_BOTTOM]
                   [--inset-left INSET_LEFT] [--inset-right INSET_RIGHT]
-                  [--inset-top INSET_TOP] [-n VARIATIONS] [--no-scale] [-q] [-v]
+                  [--inset-top INSET_TOP] [-j JOBS]
+                  [--jpeg-quality JPEG_QUALITY] [-n VARIATIONS]
+                  [--no-scale]
+                  [--png-compress-level {0,1,2,3,4,5,6,7,8,9}] [-q]
+                  [--resample {nearest,bilinear,bicubic}]
+                  [--save-threads SAVE_THREADS] [--seed SEED] [-v]
                   label
 
 Annotation Format:
@@ -35,13 +40,16 @@ Annotation Format:
 ]
 
 TODOS:
-    - (future) multiprocessing for speed (split photo batches by background)
     - (future) subject image rotation
 """
 
-import logging, os, time, copy, random, json
+import logging, os, io, time, random, json
 from argparse import ArgumentParser
-from PIL import Image
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+    as_completed
+from functools import lru_cache
+from PIL import Image, __version__ as PIL_VERSION
 
 
 
@@ -53,6 +61,10 @@ from PIL import Image
 N = 10
 SCALE_MAX = 80
 SCALE_MIN = 5
+SCALES = range(SCALE_MIN, SCALE_MAX + 1)
+PNG_COMPRESS_LEVEL = 1
+JPEG_QUALITY = 85
+REDUCING_GAP = 3.0
 COLOR_TEMPS = {
     1000: (255,56,0),
     1500: (255,109,0),
@@ -74,6 +86,11 @@ COLOR_TEMPS = {
     9500: (208,222,255),
     10000: (204,219,255)
 } # from http://www.vendian.org/mncharity/dir3/blackbody/
+RESAMPLE_FILTERS = {
+    "nearest": Image.NEAREST,
+    "bilinear": Image.BILINEAR,
+    "bicubic": Image.BICUBIC
+}
 
 
 # fs structure
@@ -84,6 +101,12 @@ IMG_DEST = "generated"
 ANO_FILE = "annotations.json"
 
 
+# annotation record, as json.dumps would encode it, filled with the JSON label,
+# the coordinates (y, x, width, height), and the JSON image filename
+ANO_TEMPLATE = '{"annotation": [{"label": %s, "coordinates": {"y": %d, \
+"x": %d, "width": %d, "height": %d}}], "imagefilename": %s}'
+
+
 # inset indicies
 TOP = 0
 RIGHT = 1
@@ -138,6 +161,15 @@ parser.add_argument("--inset-top",
     type=int,
     help="percentage of the subject image's height to exclude in the \
     annotation from the top of the image (range: 1–99%%)")
+parser.add_argument("-j", "--jobs",
+    type=int,
+    default=None,
+    help="the number of worker processes to generate images with (default: \
+    the number of CPUs)")
+parser.add_argument("--jpeg-quality",
+    type=int,
+    default=JPEG_QUALITY,
+    help="the quality to save JPEG composite images with (range: 1–100)")
 parser.add_argument("-n", "--variations",
     type=int,
     default=N,
@@ -146,41 +178,96 @@ parser.add_argument("--no-scale",
     action="store_true",
     help="do not change the scale of the subject image (unexepected behavior \
     for subject image larger than background image)")
+parser.add_argument("--png-compress-level",
+    choices=range(10),
+    type=int,
+    default=PNG_COMPRESS_LEVEL,
+    help="the zlib compression level to save PNG composite images with, \
+    lower is faster")
 parser.add_argument("-q", "--quiet",
     action="count",
     default=0,
     help="decrease the verbosity of log output (--verbose takes precedence)")
+parser.add_argument("--resample",
+    choices=RESAMPLE_FILTERS.keys(),
+    default="bilinear",
+    help="the filter to resample the subject image with when scaling it")
+parser.add_argument("--save-threads",
+    type=int,
+    default=None,
+    help="the number of threads each worker process saves composite images \
+    on, each needing its own copy of the background (default: enough to use \
+    the CPUs the worker processes leave idle)")
+parser.add_argument("--seed",
+    type=int,
+    help="seed the random subject scales and positions so that the same \
+    images are generated on every run")
 parser.add_argument("-v", "--verbose",
     action="count",
     default=0,
     help="increase the verbosity of log output (takes precedence over --quiet)")
-args = parser.parse_args()
 
 
-# set user log level
-if args.verbose:
-    # max is to ensure that granularity does not cross into NOTSET
-    log.setLevel(max(VERBOSITY - (args.verbose * logging.DEBUG), logging.DEBUG))
-elif args.quiet:
-    log.setLevel(VERBOSITY + (args.quiet * logging.DEBUG))
 
 
-# sanitize insets
-if args.inset_top and (args.inset_top > 99 or args.inset_top < 1):
-    log.warning("Ignoring top inset of %d%%", args.inset_top)
-    args.inset_top = None
+def parseArguments():
+    """Parses the command line and sets the log level, ignoring bad options
+
+    Called from main() only, so that worker processes that re-import this
+    module do not parse (and warn about) the options again.
+
+    Returns:
+        Namespace
+        the sanitized options
+    """
+    args = parser.parse_args()
+
+
+    # set user log level
+    if args.verbose:
+        # max is to ensure that granularity does not cross into NOTSET
+        log.setLevel(
+            max(VERBOSITY - (args.verbose * logging.DEBUG), logging.DEBUG))
+    elif args.quiet:
+        log.setLevel(VERBOSITY + (args.quiet * logging.DEBUG))
+
+
+    # sanitize insets
+    if args.inset_top and (args.inset_top > 99 or args.inset_top < 1):
+        log.warning("Ignoring top inset of %d%%", args.inset_top)
+        args.inset_top = None
+
+    if args.inset_right and (args.inset_right > 99 or args.inset_right < 1):
+        log.warning("Ignoring right inset of %d%%", args.inset_right)
+        args.inset_right = None
+
+    if args.inset_bottom and (args.inset_bottom > 99 or args.inset_bottom < 1):
+        log.warning("Ignoring bottom inset of %d%%", args.inset_bottom)
+        args.inset_bottom = None
+
+    if args.inset_left and (args.inset_left > 99 or args.inset_left < 1):
+        log.warning("Ignoring left inset of %d%%", args.inset_left)
+        args.inset_left = None
+
 
-if args.inset_right and (args.inset_right > 99 or args.inset_right < 1):
-    log.warning("Ignoring right inset of %d%%", args.inset_right)
-    args.inset_right = None
+    # sanitize encoder options
+    if args.jpeg_quality > 100 or args.jpeg_quality < 1:
+        log.warning("Ignoring JPEG quality of %d", args.jpeg_quality)
+        args.jpeg_quality = JPEG_QUALITY
 
-if args.inset_bottom and (args.inset_bottom > 99 or args.inset_bottom < 1):
-    log.warning("Ignoring bottom inset of %d%%", args.inset_bottom)
-    args.inset_bottom = None
 
-if args.inset_left and (args.inset_left > 99 or args.inset_left < 1):
-    log.warning("Ignoring left inset of %d%%", args.inset_left)
-    args.inset_left = None
+    # sanitize worker count
+    if args.jobs is not None and args.jobs < 1:
+        log.warning("Ignoring %d jobs", args.jobs)
+        args.jobs = None
+
+
+    # sanitize saver thread count
+    if args.save_threads is not None and args.save_threads < 0:
+        log.warning("Ignoring %d save threads", args.save_threads)
+        args.save_threads = None
+
+    return args
 
 
 
@@ -188,33 +275,26 @@ if args.inset_left and (args.inset_left > 99 or args.inset_left < 1):
 #### MARK: Script Execution
 
 def main():
+    args = parseArguments()
+
+
+    # Pillow-SIMD marks its releases as post-releases of Pillow
+    if "post" not in PIL_VERSION:
+        log.info("Install Pillow-SIMD for faster image processing")
 
 
     # set annotation label
-    ano_tmp = {
-        "annotation": [
-            {
-                "label": args.label,
-                "coordinates": {
-                    "y": None,
-                    "x": None,
-                    "width": None,
-                    "height": None
-                }
-            }
-        ],
-        "imagefilename": None
-    }
-    annotations = []
     log.debug("Using label: %s", args.label)
 
+    # insets are constant for the run, so convert them to fractions once
+    # (an unset inset is 0, which leaves the annotation unchanged)
     insets = (
-        args.inset_top,
-        args.inset_right,
-        args.inset_bottom,
-        args.inset_left
+        (args.inset_top or 0) / 100,
+        (args.inset_right or 0) / 100,
+        (args.inset_bottom or 0) / 100,
+        (args.inset_left or 0) / 100
     )
-    log.debug("Using insets: %s", insets)
+    log.debug("Using inset fractions: %s", insets)
 
 
     # load image folders
@@ -236,125 +316,326 @@ def main():
     started = time.time()
 
 
-    # for each background
-    for bkgd_file in os.listdir(background_dir):
-        log.debug("Opening background file: %s", bkgd_file)
+    # list image files once, each batch gets the full subject list with
+    # extensions already stripped from the names
+    subjects = [
+        (os.path.splitext(subj_file)[0], subj_path)
+        for subj_file, subj_path in listImages(subj_dir)
+    ]
+    log.debug("Found %d subject images", len(subjects))
+
+    # one batch per background, each batch is composited in its own process
+    tasks = [
+        (bkgd_file, bkgd_path, subjects, dest_dir, insets, args)
+        for bkgd_file, bkgd_path in listImages(background_dir)
+    ]
+    log.debug("Created %d background batches", len(tasks))
+
+    # never start more workers than there are batches, by default only the
+    # CPUs left idle by the workers are used for saving
+    cpus = os.cpu_count() or 1
+    workers = max(1, min(args.jobs or cpus, len(tasks)))
+    if args.save_threads is None:
+        args.save_threads = max(0, cpus // workers - 1)
+    log.debug("Using %d workers with %d save threads each", workers,
+        args.save_threads)
+
+    # store annotations as each batch finishes, rather than all at the end
+    # (workers only re-import this module, so they take the log level from
+    # here rather than parsing the options again)
+    with open(os.path.join(dest_dir, ANO_FILE), "w") as annotations_file, \
+            ProcessPoolExecutor(workers, initializer=log.setLevel,
+                initargs=(log.level,)) as pool:
+        annotations_file.write("[")
+        count = 0
+
+        # futures are dropped once written, so finished batches are freed
+        batches = {
+            pool.submit(compositeBackground, task): task[0]
+            for task in tasks
+        }
+        try:
+            for future in as_completed(batches):
+                bkgd_file = batches.pop(future)
+
+                # a failed batch loses only its own annotations
+                try:
+                    batch = future.result()
 
-        bkgd_p = Image.open(os.path.join(background_dir, bkgd_file))
-        log.debug("Opened background: %s", bkgd_file)
+                except Exception as error:
+                    log.info("Unable to composite background %s: %s",
+                        bkgd_file, error)
+                    log.warning("Skipping: %s", bkgd_file)
+                    continue
 
-        bkgd_ext = bkgd_file.split(".")[-1]
-        bkgd_file = bkgd_file.rstrip("." + bkgd_ext)
-        log.debug("Stripped background ext: %s", bkgd_ext)
+                if not batch:
+                    continue
 
-        # convert background color temp
-        if args.color_temp:
-            bkgd_tmp = convertColorTemperature(bkgd_p, args.color_temp)
-            bkgd_p.close()
-            bkgd_p = bkgd_tmp
+                # annotations arrive already encoded
+                if count:
+                    annotations_file.write(", ")
+                annotations_file.write(", ".join(batch))
+                count += len(batch)
 
+                annotations_file.flush()
+                log.debug("Wrote %d annotations to file: %s", count, ANO_FILE)
 
-        # for each subject
-        for subj_file in os.listdir(subj_dir):
-            log.debug("Opening subject file: %s", subj_file)
+        finally:
+            # on interruption, do not start the backgrounds still queued, and
+            # always leave a valid JSON array behind
+            for future in batches:
+                future.cancel()
+            annotations_file.write("]")
 
-            subj_p = Image.open(os.path.join(subj_dir, subj_file))
-            log.debug("Opened subject: %s", subj_file)
 
-            subj_ext = subj_file.split(".")[-1]
-            subj_file = subj_file.rstrip("." + subj_ext)
-            log.debug("Stripped subject ext: %s", subj_ext)
+    log.info("====================End Image Processing====================")
+    log.info("Elapsed Time: %0.4fs", (time.time() - started))
 
-            # convert background color temp
-            if args.color_temp:
-                subj_tmp = convertColorTemperature(subj_p, args.color_temp)
-                subj_p.close()
-                subj_p = subj_tmp
 
 
-            # for N variations
-            for i in range(args.variations):
-                log.debug("Started variation: %d", i)
 
-                ano = copy.deepcopy(ano_tmp)
-                log.debug("Created template annotation deep copy")
+def compositeBackground(task):
+    """Overlay each subject on a single background N times
 
+    This is the unit of work handed to each worker process, so the images are
+    opened here rather than being passed (and pickled) from the parent.
 
-                # compose filename
-                gen_ext = args.output_fmt.lower() \
-                    if args.output_fmt \
-                    else bkgd_ext
-                gen_filename = ".".join([subj_file, bkgd_file, str(i), gen_ext])
-                ano["imagefilename"] = gen_filename
-                log.debug("Set generated filename: %s", gen_filename)
+    Returns:
+        [str]
+        the JSON annotations for each composite image that was saved
+    """
+    bkgd_file, bkgd_path, subjects, dest_dir, insets, args = task
+    annotations = []
+    label = json.dumps(args.label)
 
+    # each batch draws from its own generator, seeded from the OS, so worker
+    # processes never share a random state (or from the user's seed and the
+    # background, so a batch draws the same whichever worker runs it)
+    rng = random.Random() \
+        if args.seed is None \
+        else random.Random("%d:%s" % (args.seed, bkgd_file))
+    randint = rng.randint
 
-                # create composite image
-                subj_tmp = subj_p
-                # temporary subject (points to original) #
-                if not args.no_scale:
-                    log.debug("Will scale subject")
-                    subj_tmp = scaleToBackground(subj_tmp, bkgd_p, ano, insets)
-                    # temporary subject is now separate, original untouched #
+    log.debug("Opening background file: %s", bkgd_file)
 
-                pos_x, pos_y = placeOnBackground(subj_tmp, bkgd_p, ano, insets)
+    bkgd_p = Image.open(bkgd_path)
+    log.debug("Opened background: %s", bkgd_file)
 
-                bkgd_tmp = bkgd_p.copy()
-                # temporary background copied for paste, original untouched #
-                bkgd_tmp.paste(subj_tmp, (pos_x, pos_y))
+    # decode exactly once, every canvas and restore copies from this buffer
+    if bkgd_p.mode != "RGB":
+        bkgd_tmp = bkgd_p.convert("RGB")
+        bkgd_p.close()
+        bkgd_p = bkgd_tmp
+    bkgd_p.load()
+    log.debug("Decoded background: %s", bkgd_file)
 
+    bkgd_file, bkgd_ext = os.path.splitext(bkgd_file)
+    bkgd_ext = bkgd_ext.lstrip(".")
+    log.debug("Stripped background ext: %s", bkgd_ext)
 
-                # save new image and annotation
-                try:
-                    bkgd_tmp.save(os.path.join(dest_dir, gen_filename),
-                        format=args.output_fmt)
+    # convert background color temp
+    if args.color_temp:
+        bkgd_tmp = convertColorTemperature(bkgd_p, args.color_temp)
+        bkgd_p.close()
+        bkgd_p = bkgd_tmp
+
+    # composites are saved in one format per background
+    gen_ext = args.output_fmt.lower() \
+        if args.output_fmt \
+        else bkgd_ext
+    save_params = saveParameters(args, gen_ext)
+    log.debug("Using save parameters: %s", save_params)
+
+    # composites are pasted onto canvases allocated once per background, one
+    # more than there are saver threads so that one is always being filled
+    canvases = [bkgd_p.copy() for _ in range(args.save_threads + 1)]
+    log.debug("Allocated %d canvases for background: %s", len(canvases),
+        bkgd_file)
+
+    # Pillow releases the GIL while encoding, so saves overlap compositing
+    # (without saver threads, each composite is saved before the next)
+    saver = ThreadPoolExecutor(args.save_threads) \
+        if args.save_threads \
+        else None
+    saves = deque()
+
+
+    # for each subject
+    for subj_file, subj_path in subjects:
+        log.debug("Loading subject file: %s", subj_path)
+
+        # only one decoded subject is held at a time
+        try:
+            subj_p = loadSubject(subj_path, args.color_temp)
+
+        except (OSError, ValueError) as error:
+            log.info("Unable to load subject %s for background %s: %s",
+                subj_file, bkgd_file, error)
+            log.warning("Skipping subject %s on background %s", subj_file,
+                bkgd_file)
+            continue
+
+        log.debug("Loaded subject: %s", subj_file)
+
+        # draw every variation's scale (height as percent of background image
+        # size) up front, subject resized once per scale
+        scales = rng.choices(SCALES, k=args.variations)
+        resized = {}
+
+
+        # for N variations, grouped by scale so that only one resized subject
+        # is kept at a time
+        for i in sorted(range(args.variations), key=scales.__getitem__):
+            if scales[i] not in resized:
+                for subj_tmp in resized.values():
+                    subj_tmp.close()
+                resized.clear()
+
+            # compose filename
+            gen_filename = ".".join([subj_file, bkgd_file, str(i), gen_ext])
+
+
+            # create composite image
+            subj_tmp = subj_p
+            # temporary subject (points to original) #
+            try:
+                if not args.no_scale:
+                    subj_tmp = scaleToBackground(subj_tmp, bkgd_p, resized,
+                        RESAMPLE_FILTERS[args.resample], scales[i])
+                    # temporary subject is now cached, original untouched #
+
+                pos_x, pos_y = placeOnBackground(subj_tmp, bkgd_p, randint)
+
+            except (OSError, ValueError) as error:
+                # variations run smallest first, so no larger one would fit
+                log.info("Unable to place subject %s on background %s: %s",
+                    subj_file, bkgd_file, error)
+                log.warning("Skipping subject %s on background %s", subj_file,
+                    bkgd_file)
+                break
+
+            ano = ANO_TEMPLATE % (label,
+                *annotateSubject(subj_tmp.size, (pos_x, pos_y), insets),
+                json.dumps(gen_filename))
+
+            # wait for the oldest save if every canvas is in use
+            if not canvases:
+                future, canvas, saved_ano = saves.popleft()
+                if future.result():
+                    annotations.append(saved_ano)
+                canvases.append(canvas)
+
+            canvas = canvases.pop()
+            canvas.paste(subj_tmp, (pos_x, pos_y))
+            # background untouched, pasted region is restored after saving #
+            paste_box = (pos_x, pos_y,
+                pos_x + subj_tmp.width, pos_y + subj_tmp.height)
+            log.debug("Composited %s at: %s", gen_filename, paste_box)
+
+
+            # save new image, annotation is kept once the save succeeds
+            gen_path = os.path.join(dest_dir, gen_filename)
+            if saver:
+                future = saver.submit(saveComposite, canvas, gen_path,
+                    save_params, bkgd_p, paste_box)
+                saves.append((future, canvas, ano))
+
+            else:
+                if saveComposite(canvas, gen_path, save_params, bkgd_p,
+                        paste_box):
                     annotations.append(ano)
+                canvases.append(canvas)
 
-                except ValueError:
-                    log.info("Unable to determine file format")
-                    log.warning("Skipping: %s", gen_filename)
 
-                except OSError:
-                    log.info("Unable to write composite image to disk: %s",
-                        gen_filename)
-                    log.warning("Skipping: %s", gen_filename)
+        # done with this subject
+        for subj_tmp in resized.values():
+            subj_tmp.close()
+        subj_p.close()
+        log.debug("Closed subject: %s", subj_file)
 
-                finally:
-                    # close temporary images
-                    bkgd_tmp.close()
-                    if subj_tmp != subj_p:
-                        subj_tmp.close()
-                    log.debug("Closed temporary images")
 
+    # wait for the remaining saves
+    while saves:
+        future, canvas, saved_ano = saves.popleft()
+        if future.result():
+            annotations.append(saved_ano)
+        canvases.append(canvas)
+    if saver:
+        saver.shutdown()
 
-            # done with this subject
-            subj_p.close()
-            log.debug("Closed subject: %s", subj_file)
 
+    # done with this background
+    for canvas in canvases:
+        canvas.close()
+    bkgd_p.close()
+    log.debug("Closed background: %s", bkgd_file)
 
-        # done with this background
-        bkgd_p.close()
-        log.debug("Closed background: %s", bkgd_file)
+    return annotations
 
 
-    log.info("====================End Image Processing====================")
-    log.info("Elapsed Time: %0.4fs", (time.time() - started))
 
 
-    # store annotations
-    annotations_file = open(os.path.join(dest_dir, ANO_FILE), "w")
-    annotations_file.write(json.dumps(annotations))
-    annotations_file.close()
-    log.debug("Wrote annotations to file: %s", ANO_FILE)
+#### MARK: Helper functions
 
+def listImages(directory):
+    """Lists the files in a directory that Pillow can open
+
+    Hidden files (e.g. .DS_Store) and files without an extension registered
+    with Pillow are skipped.  Files are sorted by name, so that seeded runs
+    do not depend on the directory order.
+
+    Returns:
+        [(str, str)]
+        the (name, path) of each image file
+    """
+    extensions = Image.registered_extensions()
+
+    with os.scandir(directory) as entries:
+        return sorted(
+            (entry.name, entry.path)
+            for entry in entries
+            if entry.is_file()
+            and not entry.name.startswith(".")
+            and os.path.splitext(entry.name)[1].lower() in extensions
+        )
 
 
 
-#### MARK: Helper functions
 
-def scaleToBackground(subj_p, bkgd_p, annotation, insets):
+def loadSubject(subj_path, color_temp):
+    """Opens and decodes a subject image, converting its color temperature
+
+    Decoded once per background batch and shared by all of that pair's
+    variations.
+
+    Returns:
+        Image
+        the decoded subject image
+    """
+    subj_p = Image.open(subj_path)
+
+    # convert subject color temp
+    if color_temp:
+        subj_tmp = convertColorTemperature(subj_p, color_temp)
+        subj_p.close()
+        subj_p = subj_tmp
+
+    subj_p.load()
+    return subj_p
+
+
+
+
+def scaleToBackground(subj_p, bkgd_p, resized, resample, scale):
     """Scale the subject image up or down, relative to the background
 
+    The scale is the subject's height as a percent of the background's.
+
+    Resized images are kept in `resized` by scale, so a scale that is drawn
+    again for the same subject and background reuses the earlier resize.
+    Large downscales are first reduced by an integer factor, which Pillow
+    documents as indistinguishable from a full resample at a gap of 3.
+
     Returns:
         Image
         in the new size
@@ -362,37 +643,47 @@ def scaleToBackground(subj_p, bkgd_p, annotation, insets):
     subj_w, subj_h = subj_p.size
     bkgd_w, bkgd_h = bkgd_p.size
 
-    # pick a random scale (height as percent of background image size)
-    scale = random.randint(SCALE_MIN, SCALE_MAX) / 100
-    log.debug("Set subject scale: %f", scale)
-    subj_w = int(subj_w * (bkgd_h * scale) / subj_h)
-    subj_h = int(bkgd_h * scale)
-    log.debug("Set subject sizes (w x h): (%d, %d)", subj_w, subj_h)
+    image = resized.get(scale)
+    if image is None:
+        # same rounding as a fractional scale, cached by whole percent
+        fraction = scale / 100
+        subj_w = int(subj_w * (bkgd_h * fraction) / subj_h)
+        subj_h = int(bkgd_h * fraction)
+        image = subj_p.resize((subj_w, subj_h), resample,
+            reducing_gap=REDUCING_GAP)
+        resized[scale] = image
+        log.debug("Resized subject for scale %d%% (w x h): (%d, %d)", scale,
+            subj_w, subj_h)
 
-    image = subj_p.resize((subj_w, subj_h))
+    return image
 
-    # update annotation
-    if insets[RIGHT]:
-        subj_w -= int((insets[RIGHT] / 100) * subj_w)
-        log.debug("Applied right-side inset of %d%%", insets[RIGHT])
 
-    if insets[LEFT]:
-        subj_w -= int((insets[LEFT] / 100) * subj_w)
-        log.debug("Applied left-side inset of %d%% to width", insets[LEFT])
 
-    if insets[TOP]:
-        subj_h -= int((insets[TOP] / 100) * subj_h)
-        log.debug("Applied top-side inset of %d%% to height", insets[TOP])
 
-    if insets[BOTTOM]:
-        subj_h -= int((insets[BOTTOM] / 100) * subj_h)
-        log.debug("Applied bottom-side inset of %d%%", insets[BOTTOM])
+def annotateSubject(size, position, insets):
+    """Computes the annotation coordinates of a subject on the background
 
-    annotation["annotation"][0]["coordinates"]["width"] = subj_w
-    annotation["annotation"][0]["coordinates"]["height"] = subj_h
-    log.debug("Updated annotation sizes")
+    Each side's inset is truncated to whole pixels in turn, the left and
+    bottom insets applying to what the right and top insets leave.
 
-    return image
+    Returns:
+        (int, int, int, int)
+        the inset (y, x, width, height) of the subject image
+    """
+    subj_w, subj_h = size
+    position_x, position_y = position
+
+    width = subj_w - int(subj_w * insets[RIGHT])
+    width -= int(width * insets[LEFT])
+    height = subj_h - int(subj_h * insets[TOP])
+    height -= int(height * insets[BOTTOM])
+
+    return (
+        position_y - int(subj_h * insets[TOP]),
+        position_x + int(subj_w * insets[LEFT]),
+        width,
+        height
+    )
 
 
 
@@ -403,22 +694,106 @@ def convertColorTemperature(img_p, temp):
     This function was inspired by this StackOverflow answer:
     https://stackoverflow.com/a/11888449
 
+    The color matrix from that answer only scales each channel, so it is
+    applied as a per-channel lookup table instead of a matrix conversion.
+
     Returns:
         Image
         the color-temperature-adjusted image
     """
+    if img_p.mode != 'RGB':
+        img_p = img_p.convert('RGB')
+    return img_p.point(colorTemperatureTable(temp))
+
+
+
+
+@lru_cache(maxsize=None)
+def colorTemperatureTable(temp):
+    """Builds the per-channel lookup table for a color temperature
+
+    Built once per temperature and reused for every image converted to it.
+
+    Returns:
+        (int, ...)
+        the 256 red, then green, then blue channel values
+    """
     r, g, b = COLOR_TEMPS[temp]
-    matrix = (
-        r/255.0, 0.0,     0.0,     0.0,
-        0.0,     g/255.0, 0.0,     0.0,
-        0.0,     0.0,     b/255.0, 0.0
+    return tuple(
+        int(i * c / 255.0 + 0.5) for c in (r, g, b) for i in range(256)
     )
-    return img_p.convert('RGB', matrix)
 
 
 
 
-def placeOnBackground(subj_p, bkgd_p, annotation, insets):
+def saveComposite(canvas, path, params, bkgd_p, paste_box):
+    """Saves a composite image, then restores its canvas from the background
+
+    The image is encoded in memory first and written to disk in one call,
+    rather than in many small writes as the encoder produces output.
+
+    Returns:
+        bool
+        whether the composite image was saved
+    """
+    try:
+        encoded = io.BytesIO()
+        canvas.save(encoded, **params)
+        with open(path, "wb") as image_file:
+            image_file.write(encoded.getbuffer())
+        return True
+
+    except ValueError:
+        log.info("Unable to determine file format")
+        log.warning("Skipping: %s", os.path.basename(path))
+
+    except OSError:
+        log.info("Unable to write composite image to disk: %s",
+            os.path.basename(path))
+        log.warning("Skipping: %s", os.path.basename(path))
+
+    finally:
+        # restore canvas where the subject was pasted
+        canvas.paste(bkgd_p.crop(paste_box), paste_box)
+
+    return False
+
+
+
+
+def saveParameters(args, ext):
+    """Chooses the encoder options to save composite images with
+
+    The format is always resolved here, since composites are encoded into
+    memory where Pillow has no filename to detect it from.  PNG and JPEG are
+    tuned for throughput over file size, other formats are saved with
+    Pillow's defaults.
+
+    Returns:
+        dict
+        the keyword arguments for Image.save
+    """
+    fmt = args.output_fmt.upper() \
+        if args.output_fmt \
+        else Image.registered_extensions().get("." + ext.lower())
+    params = {"format": fmt}
+
+    if fmt == "PNG":
+        params["compress_level"] = args.png_compress_level
+
+    elif fmt == "JPEG":
+        # single pass, baseline, 4:2:0 chroma subsampling
+        params["quality"] = args.jpeg_quality
+        params["optimize"] = False
+        params["progressive"] = False
+        params["subsampling"] = 2
+
+    return params
+
+
+
+
+def placeOnBackground(subj_p, bkgd_p, randint=random.randint):
     """Chooses a position for the subject image on the background
 
     Returns:
@@ -430,26 +805,10 @@ def placeOnBackground(subj_p, bkgd_p, annotation, insets):
 
     # pick a random position for top-left corner (ensure subject stays
     # in bounds of background)
-    position_x = random.randint(0, bkgd_w - subj_w)
-    position_y = random.randint(0, bkgd_h - subj_h)
-    log.debug("Set subject position (x, y): (%d, %d)", position_x, position_y)
-
-    image_x, image_y = (position_x, position_y)
-
-    # update annotation
-    if insets[LEFT]:
-        position_x += int((insets[LEFT] / 100) * subj_w)
-        log.debug("Applied left-side inset of %d%% to x-coord", insets[LEFT])
-
-    if insets[TOP]:
-        position_y -= int((insets[TOP] / 100) * subj_h)
-        log.debug("Applied top-side inset of %d%% to y-coord", insets[TOP])
-
-    annotation["annotation"][0]["coordinates"]["y"] = position_y
-    annotation["annotation"][0]["coordinates"]["x"] = position_x
-    log.debug("Updated annotation position")
+    position_x = randint(0, bkgd_w - subj_w)
+    position_y = randint(0, bkgd_h - subj_h)
 
-    return (image_x, image_y)
+    return (position_x, position_y)
 
 
 